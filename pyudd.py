@@ -11,7 +11,10 @@ __contact__ = 'ange@corkami.com'
 __revision__ = "$Revision$"
 __version__ = '0.1 r%d' % int(__revision__[11:-2])
 
+import os
 import struct
+import threading
+import zlib
 
 HDR_STRING = "Mod\x00"
 FTR_STRING = "\nEnd"
@@ -219,6 +222,14 @@ def init_mappings():
 
 UDD_FORMATS, F_, CHUNK_TYPES, CHUNK_FORMATS, OLLY2CATS = init_mappings()
 
+# analysis blobs, regenerated by OllyDbg: safe to strip.
+# AnalyseHint holds user-set hints and ANC is unknown: both are kept
+ANALYSIS_TYPES = ["JDT", "PRC", "SWI", "ANA", "CAS"]
+
+# analysis blobs and MRU lists, ignored by user data fingerprints
+VOLATILE_TYPES = ANALYSIS_TYPES + ["LSA"] + sorted(
+    e for e in CHUNK_TYPES[11] if e.startswith("MRU_"))
+
 def binstr(data):
     """return a stream as hex sequence"""
     return " ".join(["%02X" % ord(c) for c in data])
@@ -233,20 +244,27 @@ class Error(Exception):
     """custom error class"""
     pass
 
-def crc32mpeg(buffer_):
-    """computes the CRC32 MPEG of a buffer"""
-    crc = 0xffffffff
-    for c in buffer_:
-        octet = ord(c)
-
+def init_crc32mpeg_table():
+    """computes the CRC32 MPEG of each byte value, for crc32mpeg"""
+    table = []
+    for octet in range(256):
+        crc = octet << 24
         for i in range(8):
             topbit = crc & 0x80000000
-            if octet & (0x80 >> i):
-                topbit ^= 0x80000000
             crc <<= 1
             if topbit:
                 crc ^= 0x4c11db7
-        crc &= 0xffffffff
+        table.append(crc & 0xffffffff)
+    return table
+
+CRC32MPEG_TABLE = init_crc32mpeg_table()
+
+def crc32mpeg(buffer_):
+    """computes the CRC32 MPEG of a buffer"""
+    crc = 0xffffffff
+    table = CRC32MPEG_TABLE
+    for octet in bytearray(buffer_):
+        crc = ((crc << 8) & 0xffffffff) ^ table[(crc >> 24) ^ octet]
 
     return crc
 
@@ -254,7 +272,7 @@ def getcrc(filename):
     """returns the UDD crc of a file, by its filename"""
     # probably not always correct
     import pefile
-    pe = pefile.PE(filename)
+    pe = pefile.PE(filename, fast_load=True)
     sec = pe.sections[0]
     align = pe.OPTIONAL_HEADER.SectionAlignment
 
@@ -281,14 +299,52 @@ def getTimestamp(filename):
     ctypes.windll.kernel32.CloseHandle(h)
     return struct.pack("<Q", mtime.value)
 
+def filetime(mtime):
+    """return a unix time as a FILETIME binary buffer"""
+    # 100ns intervals since 1601/01/01, summed from integer parts:
+    # mtime * 10000000 as one double would lose the odd ticks
+    secs = int(mtime)
+    ticks = int(round((mtime - secs) * 10000000))
+    return struct.pack("<Q", (secs + 11644473600) * 10000000 + ticks)
+
 def getFileInfo(filename):
     """return file's timestamp, crc and size"""
-    import os
-    import stat
-    time_ = getTimestamp(filename)
+    st = os.stat(filename)
+    if os.name == "nt":
+        # exact FILETIME, as OllyDbg compares it to the module's
+        time_ = getTimestamp(filename)
+    else:
+        time_ = filetime(st.st_mtime)
     crc = getcrc(filename)
-    size = os.stat(filename)[stat.ST_SIZE]
-    return time_, crc, size
+    return time_, crc, st.st_size
+
+def create_udd(filename=None, format_=11, info=None):
+    """return a new Udd, referencing filename if given
+
+    info is the (timestamp, crc, size) of filename, computed if not given.
+
+    the v2.0 Infos (Fcr) chunk layout is a guess, not checked against files
+    written by OllyDbg 2: size, FILETIME timestamp, then the crc in the last
+    dword, which expand_chunk only knows as unk"""
+    u = Udd(format_=format_)
+    u.append_chunk([HDR_STRING, UDD_FORMATS[format_]])
+
+    if filename is not None:
+        time_, crc, size = getFileInfo(filename) if info is None else info
+
+        u.append_chunk([CHUNK_TYPES[format_]["Filename"], filename])
+        if format_ == 11:
+            u.append_chunk([CHUNK_TYPES[format_]["Size"],
+                struct.pack("<I", size)])
+            u.append_chunk([CHUNK_TYPES[format_]["Timestamp"], time_])
+            u.append_chunk([CHUNK_TYPES[format_]["CRC"],
+                struct.pack("<I", crc)])
+        else:
+            u.append_chunk([CHUNK_TYPES[format_]["Infos"],
+                struct.pack("<I", size) + time_ + struct.pack("<I", crc)])
+
+    u.append_chunk([FTR_STRING, ""])
+    return u
 
 
 def read_next_chunk(f):
@@ -308,6 +364,160 @@ def write_chunk(f, ct, cd):
     return
 
 
+def iter_chunks(f):
+    """lazily read Udd chunks, up to and including the footer"""
+    while (True):
+        try:
+            ct, cd = read_next_chunk(f)
+        except struct.error:
+            raise Error("truncated file")
+        yield [ct, cd]
+        if (ct, cd) == (FTR_STRING, ""):
+            break
+    return
+
+
+def check_header(chunk):
+    """check the HEADER chunk and return the UDD format it announces"""
+    ct, cd = chunk
+    if not (ct == HDR_STRING and
+        cd in (e[1] for e in udd_formats)):
+        raise Error("Invalid HEADER chunk")
+    return UDD_FORMATS[cd]
+
+
+def transform_file(infile, outfile, stages):
+    """stream the chunks of infile through stages, writing them to outfile
+
+    each stage is called as stage(chunk, format_) and returns the chunk to
+    pass on (possibly modified) or None to drop it. Chunks are processed one
+    at a time; header and footer are always copied.
+
+    the output is written to a temporary file, renamed to outfile once
+    complete: outfile may be infile, and is left untouched on errors"""
+    fin = open(infile, "rb")
+    try:
+        tmpfile = "%s.%i.tmp" % (outfile, os.getpid())
+        fout = open(tmpfile, "wb")
+        try:
+            chunks = iter_chunks(fin)
+            header = chunks.next()
+            format_ = check_header(header)
+            write_chunk(fout, *header)
+
+            for chunk in chunks:
+                if chunk[0] != FTR_STRING:
+                    for stage in stages:
+                        chunk = stage(chunk, format_)
+                        if chunk is None:
+                            break
+                    if chunk is None:
+                        continue
+                write_chunk(fout, *chunk)
+            fout.close()
+        except:
+            fout.close()
+            os.remove(tmpfile)
+            raise
+    finally:
+        fin.close()
+
+    replace_file(tmpfile, outfile)
+    return
+
+
+def replace_file(tmpfile, filename):
+    """rename a complete temporary file to filename, replacing it"""
+    # no atomic replacement on Windows
+    if os.name == "nt" and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmpfile, filename)
+    return
+
+
+def type_to_tag(name, format_):
+    """return the chunk tag of a type name, or None if unknown.
+
+    the tag itself is accepted too, with or without its newline ("Jdt")"""
+    types = CHUNK_TYPES[format_]
+    if name in types:
+        return name if name[:1] == "\n" or name == HDR_STRING else types[name]
+    if "\n" + name in types:
+        return "\n" + name
+    return None
+
+
+def types_to_tags(names, format_):
+    """return the chunk tags of the given type names, ignoring unknown ones"""
+    tags = set(type_to_tag(e, format_) for e in names)
+    tags.discard(None)
+    return tags
+
+
+def drop_types(names):
+    """transform stage: drop chunks whose type name is in names"""
+    tags = {}
+    def stage(chunk, format_):
+        if format_ not in tags:
+            tags[format_] = types_to_tags(names, format_)
+        if chunk[0] in tags[format_]:
+            return None
+        return chunk
+    return stage
+
+
+def keep_types(names):
+    """transform stage: only keep chunks whose type name is in names"""
+    tags = {}
+    def stage(chunk, format_):
+        if format_ not in tags:
+            tags[format_] = types_to_tags(names, format_)
+        if chunk[0] in tags[format_]:
+            return chunk
+        return None
+    return stage
+
+
+def rename_label_prefix(old, new):
+    """transform stage: replace the prefix old by new in user labels
+
+    v2.0 labels are looked for in both Name and Data records. Raises Error
+    if a renamed label gets too long for its chunk, as make_chunk does"""
+    names = types_to_tags(["Name", "Data"], 20)
+    def stage(chunk, format_):
+        ct, cd = chunk
+        if format_ == 11 and ct == CHUNK_TYPES[11]["U_LABEL"]:
+            start = 4
+        elif (format_ == 20 and ct in names and
+            cd[4:5] == OLLY2CATS["UserLabel"]):
+            start = 5
+        else:
+            return chunk
+
+        if not cd[start:].startswith(old):
+            return chunk
+        return make_chunk(ct, cd[:start] + new + cd[start + len(old):])
+    return stage
+
+
+def chunk_fingerprint(chunk):
+    """return a fast, non cryptographic, fingerprint of a chunk"""
+    ct, cd = chunk
+    return zlib.crc32(cd, zlib.crc32(ct)) & 0xffffffff
+
+
+def combine_fingerprints(chunks, fingerprints, format_, user_only=False):
+    """return the fingerprint of a whole file from its chunks fingerprints
+
+    if user_only is set, volatile chunks (see VOLATILE_TYPES) are ignored"""
+    if user_only:
+        volatile = types_to_tags(VOLATILE_TYPES, format_)
+        fingerprints = [fp for c, fp in zip(chunks, fingerprints)
+            if c[0] not in volatile]
+    return zlib.crc32(
+        struct.pack("<%iI" % len(fingerprints), *fingerprints)) & 0xffffffff
+
+
 def make_chunk(ct, cd):
     """put together chunk types and data with a few checks"""
     if len(ct) != 4:
@@ -324,11 +534,14 @@ def build_data(format_, info):
         return "%s" % (struct.pack("<I", info["dword"]))
     if format_ in [F_["DDSTRING"], F_["MRUSTRING"]]:
         return "%s%s\x00" % (struct.pack("<I", info["dword"]), info["text"])
+    if format_ == F_["NAME"]:
+        return "%s%s%s\x00" % (
+            struct.pack("<I", info["RVA"]), info["category"], info["name"])
     else:
         raise Error("format not supported for building")
 
 
-#TODO: merge those into a real make_chunk or something - support format 2
+#TODO: merge those into a real make_chunk or something
 #
 def make_comment_chunk(info, format_):
     """generate a user comment chunk depending on the format"""
@@ -337,6 +550,14 @@ def make_comment_chunk(info, format_):
             CHUNK_TYPES[format_]["U_COMMENT"],
             build_data(CHUNK_FORMATS["U_LABEL"], info)
             )
+    elif format_ == 20:
+        return make_chunk(
+            CHUNK_TYPES[format_]["Name"],
+            build_data(CHUNK_FORMATS["Name"], {
+                "RVA": info["dword"],
+                "category": OLLY2CATS["UserComment"],
+                "name": info["text"]})
+            )
     else:
         raise Error("Not supported")
 
@@ -347,10 +568,225 @@ def make_label_chunk(info, format_):
             CHUNK_TYPES[format_]["U_LABEL"],
             build_data(CHUNK_FORMATS["U_LABEL"], info)
             )
-
+    elif format_ == 20:
+        return make_chunk(
+            CHUNK_TYPES[format_]["Name"],
+            build_data(CHUNK_FORMATS["Name"], {
+                "RVA": info["dword"],
+                "category": OLLY2CATS["UserLabel"],
+                "name": info["text"]})
+            )
     else:
         raise Error("Not supported")
 
+
+# chunk type and v2.0 category of labels and comments, in that order
+ANNOTATION_KINDS = {
+    11: [("U_LABEL", None), ("U_COMMENT", None)],
+    20: [("Name", "UserLabel"), ("Name", "UserComment")],
+    }
+
+def check_annotations(records, format_):
+    """check (RVA, label, comment) records before encoding them
+
+    empty labels or comments are skipped. A record with an RVA that doesn't
+    fit a dword is rejected as a whole; a label or comment that would break
+    the chunk data length check of make_chunk is rejected on its own - the
+    other field of the record is still kept.
+    Returns the list of (chunk type, RVA, text, chunk data size) to encode,
+    and a list of (record index, RVA, field, error) tuples, field being
+    "RVA", "label" or "comment"."""
+    if format_ not in ANNOTATION_KINDS:
+        raise Error("Not supported")
+    kinds = [(CHUNK_TYPES[format_][type_], OLLY2CATS[cat] if cat else "")
+        for type_, cat in ANNOTATION_KINDS[format_]]
+    fields = ["label", "comment"]
+
+    entries = []
+    rejected = []
+    for i, record in enumerate(records):
+        RVA = record[0]
+        if not (isinstance(RVA, (int, long)) and 0 <= RVA <= 0xffffffff):
+            rejected += [(i, RVA, "RVA", "invalid RVA")]
+            continue
+        for (ct, cat), field, text in zip(kinds, fields, record[1:3]):
+            if not text:
+                continue
+            size = 4 + len(cat) + len(text) + 1
+            if size > 255:
+                rejected += [(i, RVA, field, "invalid chunk data length")]
+                continue
+            entries += [(ct, RVA, cat + text, size)]
+    return entries, rejected
+
+
+def build_annotations(records, format_):
+    """encode (RVA, label, comment) records as chunks, in a single buffer,
+    ready to be written to a file
+
+    returns the buffer and the rejected records, see check_annotations"""
+    # first pass: check records and compute the total size
+    #
+    entries, rejected = check_annotations(records, format_)
+    total = sum(8 + e[3] for e in entries)
+
+    # second pass: fill the buffer - terminating nulls are already there
+    #
+    buffer_ = bytearray(total)
+    offset = 0
+    for ct, RVA, text, size in entries:
+        buffer_[offset:offset + 4] = ct
+        struct.pack_into("<II", buffer_, offset + 4, size, RVA)
+        buffer_[offset + 12:offset + 12 + len(text)] = text
+        offset += 8 + size
+
+    return buffer_, rejected
+
+
+def build_annotation_columns(RVAs, labels, comments, format_):
+    """encode columns of RVAs, labels and comments, see build_annotations"""
+    import itertools
+    if labels is None:
+        labels = itertools.repeat(None)
+    if comments is None:
+        comments = itertools.repeat(None)
+    return build_annotations(
+        itertools.izip(RVAs, labels, comments), format_)
+
+
+def build_annotation_chunks(records, format_):
+    """encode (RVA, label, comment) records as a list of chunks, to be added
+    to a Udd
+
+    returns the chunks and the rejected records, see check_annotations"""
+    entries, rejected = check_annotations(records, format_)
+    chunks = [(ct, struct.pack("<I", RVA) + text + "\x00")
+        for ct, RVA, text, size in entries]
+    return chunks, rejected
+
+
+def split_chunks(buffer_):
+    """return the chunks serialized in a buffer"""
+    chunks = []
+    offset = 0
+    while offset < len(buffer_):
+        ct = str(buffer_[offset:offset + 4])
+        size = struct.unpack_from("<I", buffer_, offset + 4)[0]
+        chunks += [[ct, str(buffer_[offset + 8:offset + 8 + size])]]
+        offset += 8 + size
+    return chunks
+
+
+# leading dword fields of v1.1 binary records, one record per chunk -
+# OllyDbg 2.0 records are not supported.
+# Patch records go on with the original then the patched bytes, size each;
+# any remaining bytes are kept undecoded as extra
+RECORD_LAYOUTS = {
+    "Patch": ["address", "size", "flags"],
+    "Bpc": ["address", "flags"],
+    "Bpt": ["address", "flags"],
+    "HwBP": ["address", "size", "flags"],
+    "Save": ["address"],
+    }
+
+RECORD_BYTES = ["original", "patched", "extra"]
+
+class RecordColumns(object):
+    """array-backed columns of the decoded binary records of one type"""
+
+    def __init__(self, type_):
+        """initialization. type_ is a key of RECORD_LAYOUTS"""
+        import array
+        self.type_ = type_
+        self.fields = RECORD_LAYOUTS[type_]
+        self.__columns = dict((e, array.array("I")) for e in self.fields)
+        self.__columns.update((e, []) for e in RECORD_BYTES)
+        return
+
+
+    def append(self, record):
+        """add a record given as a dictionary"""
+        for e in self.fields + RECORD_BYTES:
+            self.__columns[e].append(record[e])
+        return
+
+
+    def record(self, pos):
+        """return a record as a dictionary"""
+        return dict((e, self.__columns[e][pos])
+            for e in self.fields + RECORD_BYTES)
+
+
+    def to_numpy(self):
+        """return the records as a NumPy structured array"""
+        import numpy
+        dtype = [(e, "<u4") for e in self.fields]
+        dtype += [(e, object) for e in RECORD_BYTES]
+        result = numpy.empty(len(self), dtype=dtype)
+        for e in self.fields + RECORD_BYTES:
+            result[e] = self.__columns[e]
+        return result
+
+
+    def __getitem__(self, name):
+        """return a column by name"""
+        return self.__columns[name]
+
+
+    def __len__(self):
+        return len(self.__columns[self.fields[0]])
+
+
+def decode_record(cd, type_):
+    """decode the data of a binary record chunk as a dictionary"""
+    fields = RECORD_LAYOUTS[type_]
+    size = 4 * len(fields)
+    if len(cd) < size:
+        raise Error("record too short")
+
+    record = dict(zip(fields, struct.unpack("<%iI" % len(fields), cd[:size])))
+    record.update(original="", patched="", extra=cd[size:])
+
+    if type_ == "Patch" and len(cd) >= size + 2 * record["size"]:
+        end = size + record["size"]
+        record["original"] = cd[size:end]
+        record["patched"] = cd[end:end + record["size"]]
+        record["extra"] = cd[end + record["size"]:]
+    return record
+
+
+def encode_record(record, type_):
+    """encode a record dictionary back as chunk data"""
+    fields = RECORD_LAYOUTS[type_]
+    return "".join(
+        [struct.pack("<%iI" % len(fields), *[int(record[e]) for e in fields])] +
+        [str(record[e]) for e in RECORD_BYTES])
+
+
+def decode_records(chunks, type_):
+    """decode all records of a type from v1.1 chunks (a list, a
+    UddSnapshot...) into RecordColumns"""
+    if hasattr(chunks, "get_format") and chunks.get_format() != 11:
+        raise Error("Not supported")
+    ct = CHUNK_TYPES[11][type_]
+    columns = RecordColumns(type_)
+    for c in chunks:
+        if c[0] == ct:
+            columns.append(decode_record(c[1], type_))
+    return columns
+
+
+def encode_records(columns, type_):
+    """encode records columns back as a list of v1.1 chunks
+
+    columns can be RecordColumns or a NumPy structured array"""
+    ct = CHUNK_TYPES[11][type_]
+    names = RECORD_LAYOUTS[type_] + RECORD_BYTES
+    data = [columns[e] for e in names]
+    return [[ct, encode_record(dict(zip(names, row)), type_)]
+        for row in zip(*data)]
+
+
 
 def expand_chunk(chunk, format_):
     """Extract information from the chunk data"""
@@ -486,6 +922,106 @@ def print_chunk(chunk, format_):
         result = cd
     return result
 
+
+def print_chunks(chunks, format_):
+    """Pretty print a list of chunks, one per line"""
+    r = []
+    for i in chunks:
+        if i[0] in CHUNK_TYPES[format_]:
+            s = ["%s:" % CHUNK_TYPES[format_][i[0]]]
+        else:
+            s = ["UNK[%s]:" % i[0][1:4]]
+        s += [print_chunk(i, format_)]
+        r += ["".join(s)]
+    return "\n".join(r)
+
+
+# v2.0 categories of the v1.1 user data chunk types, for query_chunks
+CATEGORIES11 = {
+    "U_LABEL": "UserLabel",
+    "U_COMMENT": "UserComment",
+    "Watch": "watch",
+    "LogExplanation": "log_explanation",
+    "LogExpression": "log_expression",
+    "MRU_Label": "mru_label",
+    "MRU_Asm": "mru_asm",
+    "MRU_Comment": "mru_comment",
+    "MRU_Goto": "mru_goto",
+    }
+
+def query_chunks(chunks, format_, types=None, categories=None,
+        rva_range=None, name_regex=None):
+    """lazily yield the records of chunks matching all given filters
+
+    types are chunk type names, categories are OLLY2CATS names or letters -
+    v1.1 chunks get theirs from CATEGORIES11, rva_range is a (start, end)
+    half-open range and name_regex is searched in texts. Tags, categories
+    and RVAs are checked on the raw data; only matching chunks are decoded.
+
+    records are dictionaries with index, type, category, RVA and text;
+    category and RVA are None when not applicable. Texts are escaped with
+    string-escape in both formats, as expand_chunk does for v1.1 strings,
+    and name_regex is searched in the escaped text"""
+    import re
+
+    tags = types_to_tags(types, format_) if types is not None else None
+    if categories is not None:
+        categories = set(e if len(e) == 1 else OLLY2CATS[e]
+            for e in categories)
+    if name_regex is not None:
+        name_regex = re.compile(name_regex)
+
+    # category letters of the v1.1 tags
+    cats11 = dict((CHUNK_TYPES[11][k], OLLY2CATS[v])
+        for k, v in CATEGORIES11.items())
+
+    for i, chunk in enumerate(chunks):
+        ct, cd = chunk
+        if ct not in CHUNK_TYPES[format_] or (tags is not None and
+                ct not in tags):
+            continue
+        cf = CHUNK_FORMATS[CHUNK_TYPES[format_][ct]]
+
+        if cf == F_["NAME"]:
+            category = cd[4:5]
+        elif format_ == 11:
+            category = cats11.get(ct)
+        else:
+            category = None
+        if categories is not None and category not in categories:
+            continue
+
+        has_rva = cf in (F_["NAME"], F_["DDSTRING"]) and len(cd) >= 4
+        if rva_range is not None:
+            if not has_rva:
+                continue
+            RVA = struct.unpack("<I", cd[:4])[0]
+            if not rva_range[0] <= RVA < rva_range[1]:
+                continue
+
+        info = expand_chunk(chunk, format_)
+        if cf == F_["NAME"]:
+            text = info.get("name", "").encode('string-escape')
+        elif cf in (F_["DDSTRING"], F_["MRUSTRING"]):
+            text = info["text"]
+        elif cf == F_["STRING"]:
+            text = info["string"].rstrip("\x00").encode('string-escape')
+        else:
+            text = None
+
+        if name_regex is not None and (text is None or
+                not name_regex.search(text)):
+            continue
+
+        yield {
+            "index": i,
+            "type": CHUNK_TYPES[format_][ct],
+            "category": OLLY2CATS.get(category, category),
+            "RVA": struct.unpack("<I", cd[:4])[0] if has_rva else None,
+            "text": text,
+            }
+    return
+
 
 class Udd(object):
     """OllyDbg UDD file format class"""
@@ -494,8 +1030,15 @@ class Udd(object):
         """initialization. load file if given"""
         self.__data = {}
         self.__chunks = []
+        self.__fingerprints = []
         self.__warnings = []
 
+        # chunks are stored as (type, data) tuples, so that they can't be
+        # changed in place. chunks and fingerprints lists are shared with
+        # snapshots until the next modification
+        self.__shared = False
+        self.__lock = threading.Lock()
+
         self.__format = 11 if format_ is None else format_
 
         if filename is not None:
@@ -509,30 +1052,57 @@ class Udd(object):
             f = open(filename, "rb")
             ct, cd =  read_next_chunk(f)
 
-            if not (ct == HDR_STRING and
-                cd in (e[1] for e in udd_formats)):
-                raise Error("Invalid HEADER chunk")
-
-            self.__format = UDD_FORMATS[cd]
+            format_ = check_header([ct, cd])
 
-            self.__chunks.append([ct, cd])
+            chunks = [(ct, cd)]
+            fingerprints = [chunk_fingerprint([ct, cd])]
             while (True):
                 ct, cd = read_next_chunk(f)
 
-                if ct not in CHUNK_TYPES[self.__format]:
+                if ct not in CHUNK_TYPES[format_]:
                     self.__warnings.append(
                         "Warning (offset %08X) unknown chunk type: '%s' %s" %
                             (f.tell(), ct.lstrip("\n"), elbinstr(cd))
                         )
-                self.__chunks.append([ct, cd])
-                if (ct, cd) == (CHUNK_TYPES[self.__format]["Footer"] , ""):
+                chunks.append((ct, cd))
+                fingerprints.append(chunk_fingerprint([ct, cd]))
+                if (ct, cd) == (CHUNK_TYPES[format_]["Footer"] , ""):
                     break
 
         finally:
             f.close()
+
+        with self.__lock:
+            self.__format = format_
+            chunks_, fingerprints_ = self.__writable()
+            chunks_.extend(chunks)
+            fingerprints_.extend(fingerprints)
         return
 
 
+    def __writable(self):
+        """return the chunks and fingerprints lists, copied first if
+        snapshots share them.
+
+        to be called with the lock held"""
+        if self.__shared:
+            self.__chunks = list(self.__chunks)
+            self.__fingerprints = list(self.__fingerprints)
+            self.__shared = False
+        return self.__chunks, self.__fingerprints
+
+
+    def snapshot(self):
+        """return a read-only view of the current chunks.
+
+        the view shares the chunks list until this Udd is next modified,
+        so taking one is cheap and reading it never blocks writers"""
+        with self.__lock:
+            self.__shared = True
+            return UddSnapshot(
+                self.__chunks, self.__format, self.__fingerprints)
+
+
     def save(self, filename):
         """(over)writes UDD file to disk"""
         f = open(filename, "wb")
@@ -544,7 +1114,11 @@ class Udd(object):
 
     def set_chunk(self, pos, chunk):
         """give new values to a chunk"""
-        self.__chunks[pos] = chunk
+        chunk = tuple(chunk)
+        with self.__lock:
+            chunks, fingerprints = self.__writable()
+            chunks[pos] = chunk
+            fingerprints[pos] = chunk_fingerprint(chunk)
         return
 
 
@@ -555,14 +1129,54 @@ class Udd(object):
 
     def add_chunk(self, chunk):
         """append a chunk before the footer"""
-        if not self.find_chunk(chunk):
-            self.__chunks.insert(-1, chunk)
+        chunk = tuple(chunk)
+        with self.__lock:
+            if not self.find_chunk(chunk):
+                chunks, fingerprints = self.__writable()
+                chunks.insert(-1, chunk)
+                fingerprints.insert(-1, chunk_fingerprint(chunk))
+        return
+
+
+    def add_chunks(self, chunks):
+        """append new chunks before the footer, skipping known ones"""
+        with self.__lock:
+            known = set(self.__chunks)
+            new = []
+            for c in chunks:
+                c = tuple(c)
+                if c not in known:
+                    known.add(c)
+                    new += [c]
+            chunks, fingerprints = self.__writable()
+            chunks[-1:-1] = new
+            fingerprints[-1:-1] = [chunk_fingerprint(c) for c in new]
+        return
+
+
+    def replace_by_type(self, type_, chunks):
+        """replace all chunks of the given type by chunks, at the place of
+        the first one, or before the footer if none"""
+        chunks = [tuple(c) for c in chunks]
+        with self.__lock:
+            old_chunks, old_fingerprints = self.__writable()
+            found = [i for i, c in enumerate(old_chunks) if c[0] == type_]
+            pos = found[0] if found else len(old_chunks) - 1
+            for i in reversed(found):
+                del old_chunks[i]
+                del old_fingerprints[i]
+            old_chunks[pos:pos] = chunks
+            old_fingerprints[pos:pos] = [chunk_fingerprint(c) for c in chunks]
         return
 
 
     def append_chunk(self, chunk):
         """blindly append the chunk"""
-        self.__chunks.append(chunk)
+        chunk = tuple(chunk)
+        with self.__lock:
+            chunks, fingerprints = self.__writable()
+            chunks.append(chunk)
+            fingerprints.append(chunk_fingerprint(chunk))
         return
 
     def get_format(self):
@@ -570,6 +1184,17 @@ class Udd(object):
         return self.__format
 
 
+    def get_fingerprints(self):
+        """return the fingerprints of all chunks"""
+        return list(self.__fingerprints)
+
+
+    def fingerprint(self, user_only=False):
+        """return the fingerprint of the whole file, or of its user data"""
+        return combine_fingerprints(self.__chunks, self.__fingerprints,
+            self.__format, user_only)
+
+
     def find_by_type(self, type_):
         """return chunk indexes matching the given type"""
         found = []
@@ -594,21 +1219,594 @@ class Udd(object):
         """lookup chunk by its type and data"""
         found = []
 
+        chunk = tuple(chunk)
         for i, c in enumerate(self.__chunks):
             if c == chunk:
                 found += [i]
         return found if found else None
 
 
+    def query(self, types=None, categories=None, rva_range=None,
+            name_regex=None):
+        """lazily yield the records matching all filters, see query_chunks"""
+        return query_chunks(self.__chunks, self.__format, types, categories,
+            rva_range, name_regex)
+
+
+    def __repr__(self):
+        """pretty print of a UDD"""
+        return print_chunks(self.__chunks, self.__format)
+
+
+class UddSnapshot(object):
+    """read-only view of the chunks of a Udd at a given time"""
+
+    def __init__(self, chunks, format_, fingerprints=None):
+        """initialization. lists must not be modified afterwards"""
+        self.__chunks = chunks
+        self.__format = format_
+        if fingerprints is None:
+            fingerprints = [chunk_fingerprint(c) for c in chunks]
+        self.__fingerprints = fingerprints
+        return
+
+
+    def save(self, filename):
+        """writes the snapshot as a UDD file to disk"""
+        f = open(filename, "wb")
+        for ct, cd in self.__chunks:
+            write_chunk(f, ct, cd)
+        f.close()
+        return
+
+
+    def get_chunk(self, pos):
+        """return chunk contents"""
+        return tuple(self.__chunks[pos])
+
+
+    def get_format(self):
+        """return UDD file format"""
+        return self.__format
+
+
+    def get_fingerprints(self):
+        """return the fingerprints of all chunks"""
+        return list(self.__fingerprints)
+
+
+    def fingerprint(self, user_only=False):
+        """return the fingerprint of the whole file, or of its user data"""
+        return combine_fingerprints(self.__chunks, self.__fingerprints,
+            self.__format, user_only)
+
+
+    def find_by_type(self, type_):
+        """return chunk indexes matching the given type"""
+        return [i for i, c in enumerate(self.__chunks) if c[0] == type_]
+
+
+    def find_by_types(self, types):
+        """return chunk indexes matching any of the given types"""
+        return [i for i, c in enumerate(self.__chunks) if c[0] in types]
+
+
+    def find_chunk(self, chunk):
+        """lookup chunk by its type and data"""
+        found = [i for i, c in enumerate(self.__chunks)
+            if tuple(c) == tuple(chunk)]
+        return found if found else None
+
+
+    def query(self, types=None, categories=None, rva_range=None,
+            name_regex=None):
+        """lazily yield the records matching all filters, see query_chunks"""
+        return query_chunks(self.__chunks, self.__format, types, categories,
+            rva_range, name_regex)
+
+
+    def __len__(self):
+        return len(self.__chunks)
+
+
+    def __iter__(self):
+        for c in self.__chunks:
+            yield tuple(c)
+
+
     def __repr__(self):
         """pretty print of a UDD"""
-        r = []
-        for i in self.__chunks:
-            if i[0] in CHUNK_TYPES[self.__format]:
-                s = ["%s:" % CHUNK_TYPES[self.__format][i[0]]]
+        return print_chunks(self.__chunks, self.__format)
+
+
+
+def user_records(chunks, format_):
+    """return {(kind, RVA): text} for the user labels and comments in chunks
+
+    kind is either "label" or "comment"; texts are escaped"""
+    if format_ == 11:
+        kinds = {
+            CHUNK_TYPES[11]["U_LABEL"]: "label",
+            CHUNK_TYPES[11]["U_COMMENT"]: "comment",
+            }
+    else:
+        kinds = {
+            OLLY2CATS["UserLabel"]: "label",
+            OLLY2CATS["UserComment"]: "comment",
+            }
+        names = types_to_tags(["Name", "Data"], 20)
+
+    records = {}
+    for ct, cd in chunks:
+        if format_ == 11 and ct in kinds:
+            info = expand_chunk([ct, cd], format_)
+            records[(kinds[ct], info["dword"])] = info["text"]
+        elif format_ == 20 and ct in names and cd[4:5] in kinds:
+            info = expand_chunk([ct, cd], format_)
+            records[(kinds[cd[4:5]], info["RVA"])] = \
+                info.get("name", "").encode('string-escape')
+    return records
+
+
+def scan_udd(filename, offset=None):
+    """read the chunks of a UDD file, or only those from offset if given
+
+    returns the format, the chunks and the offset of the footer"""
+    f = open(filename, "rb")
+    try:
+        format_ = check_header(read_next_chunk(f))
+        if offset is not None:
+            f.seek(offset)
+        chunks = list(iter_chunks(f))
+        footer = f.tell() - 8
+        if f.read(1):
+            raise Error("data after the footer")
+    except struct.error:
+        raise Error("truncated file")
+    finally:
+        f.close()
+    return format_, chunks, footer
+
+
+def range_fingerprint(filename, start, end, crc=0):
+    """return the CRC32 of the bytes of a file from start to end,
+    continued from crc - so that ranges can be chained"""
+    f = open(filename, "rb")
+    try:
+        f.seek(start)
+        left = end - start
+        while left > 0:
+            block = f.read(min(left, 1 << 20))
+            if not block:
+                raise Error("truncated file")
+            crc = zlib.crc32(block, crc)
+            left -= len(block)
+    finally:
+        f.close()
+    return crc & 0xffffffff
+
+
+class UddWatcher(object):
+    """polls a directory tree for UDD changes, and reports labels and comments
+    changes as (event, path, kind, RVA, text) tuples, where event is one of
+    "added", "removed" or "changed".
+
+    each known file is tracked by its size, mtime, footer offset and the
+    fingerprint of its bytes before the footer: a file which only grew and
+    whose bytes before the old footer are unchanged is parsed from that
+    offset, as OllyDbg appended chunks. Other files are fully parsed."""
+
+    def __init__(self, root, state=None, mask="*.udd"):
+        """initialization. load the state file if given and present"""
+        self.__root = root
+        self.__mask = mask
+        self.__state = state
+        self.__files = {}
+
+        if state is not None and os.path.exists(state):
+            self.load_state(state)
+        return
+
+
+    def load_state(self, filename):
+        """load the table of known files"""
+        import json
+        f = open(filename, "rb")
+        try:
+            table = json.load(f)
+        finally:
+            f.close()
+
+        # paths are stored as latin-1 to keep any byte, since version 2
+        if "version" in table:
+            table, encoding = table["files"], "latin-1"
+        else:
+            encoding = "utf-8"
+
+        self.__files = {}
+        for path, entry in table.items():
+            if len(entry) == 5:
+                # no prefix fingerprint in older states: force a full parse
+                entry = entry[:3] + [None] + entry[3:]
+            size, mtime, footer, prefix, format_, records = entry
+            self.__files[path.encode(encoding)] = [size, mtime, footer, prefix,
+                format_, dict(((str(kind), RVA), str(text))
+                    for kind, RVA, text in records)]
+        return
+
+
+    def save_state(self, filename=None):
+        """save the table of known files, through a temporary file so that
+        an interrupted save leaves the previous state"""
+        import json
+        if filename is None:
+            filename = self.__state
+        table = {}
+        for path, (size, mtime, footer, prefix, format_, records) in \
+                self.__files.items():
+            table[path] = [size, mtime, footer, prefix, format_,
+                [[kind, RVA, text] for (kind, RVA), text in records.items()]]
+
+        tmpfile = "%s.%i.tmp" % (filename, os.getpid())
+        f = open(tmpfile, "wb")
+        try:
+            json.dump({"version": 2, "files": table}, f, encoding="latin-1")
+            f.close()
+        except:
+            f.close()
+            os.remove(tmpfile)
+            raise
+        replace_file(tmpfile, filename)
+        return
+
+
+    def __parse(self, path, size, known):
+        """parse a changed file, return its table entry and events"""
+        if (known is not None and size > known[0] and
+                known[3] is not None and
+                range_fingerprint(path, 0, known[2]) == known[3]):
+            try:
+                format_, chunks, footer = scan_udd(path, known[2])
+            except Error:
+                pass
+            else:
+                if format_ == known[4]:
+                    prefix = range_fingerprint(path, known[2], footer,
+                        known[3])
+                    records = dict(known[5])
+                    events = []
+                    for key, text in sorted(
+                            user_records(chunks, format_).items()):
+                        if key not in records:
+                            events += [("added",) + key + (text,)]
+                        elif records[key] != text:
+                            events += [("changed",) + key + (text,)]
+                        records[key] = text
+                    return [footer, prefix, format_, records], events
+
+        format_, chunks, footer = scan_udd(path)
+        prefix = range_fingerprint(path, 0, footer)
+        records = user_records(chunks, format_)
+        old = known[5] if known is not None else {}
+        events = []
+        for key, text in sorted(records.items()):
+            if key not in old:
+                events += [("added",) + key + (text,)]
+            elif old[key] != text:
+                events += [("changed",) + key + (text,)]
+        for key, text in sorted(old.items()):
+            if key not in records:
+                events += [("removed",) + key + (text,)]
+        return [footer, prefix, format_, records], events
+
+
+    def poll(self):
+        """scan the directory tree once, return the list of events"""
+        import fnmatch
+
+        events = []
+        seen = set()
+        for dirpath, dirnames, filenames in os.walk(self.__root):
+            for name in fnmatch.filter(filenames, self.__mask):
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                seen.add(path)
+
+                known = self.__files.get(path)
+                if known is not None and \
+                        (known[0], known[1]) == (st.st_size, st.st_mtime):
+                    continue
+
+                try:
+                    entry, changes = self.__parse(path, st.st_size, known)
+                except (Error, IOError):
+                    # probably being written - retry on next poll
+                    continue
+
+                self.__files[path] = [st.st_size, st.st_mtime] + entry
+                events += [(e[0], path) + e[1:] for e in changes]
+
+        for path in sorted(set(self.__files) - seen):
+            for (kind, RVA), text in sorted(self.__files.pop(path)[5].items()):
+                events += [("removed", path, kind, RVA, text)]
+        return events
+
+
+    def watch(self, callback, interval=2.0, once=False):
+        """poll forever, passing each event to callback and saving the state
+        after each poll"""
+        import time
+        while (True):
+            for event in self.poll():
+                callback(event)
+            if self.__state is not None:
+                self.save_state()
+            if once:
+                break
+            time.sleep(interval)
+        return
+
+
+
+# big analysis chunks of OllyDbg 2.0, see BlobFile.
+# none of them has a known record layout: their views are unstructured
+# unless the caller gives a record size
+BLOB_TYPES = ["ANA", "CAS", "JDT", "PRC", "SWI"]
+
+class BlobView(object):
+    """lazy view over the data of one chunk, backed by a file mapping
+
+    with a record size, the data is seen as fixed-size records; trailing
+    bytes which do not make a whole record are left out of the records but
+    still counted in size. Without one, the view is unstructured and its
+    items are single bytes. Only accessed items are copied out of the
+    mapping"""
+
+    def __init__(self, mapping, type_, offset, size, record_size=None):
+        """initialization. offset and size locate the chunk data"""
+        if record_size is not None and record_size < 1:
+            raise Error("invalid record size")
+        self.__mapping = mapping
+        self.type_ = type_
+        self.offset = offset
+        self.size = size
+        self.record_size = record_size
+        return
+
+
+    def with_record_size(self, record_size):
+        """return a view of the same data with another record size"""
+        return BlobView(self.__mapping, self.type_, self.offset, self.size,
+            record_size)
+
+
+    def is_structured(self):
+        """return whether the view has a record size"""
+        return self.record_size is not None
+
+
+    def __len__(self):
+        """return the record count, or the byte count if unstructured"""
+        return self.size // (self.record_size or 1)
+
+
+    def __getitem__(self, pos):
+        """return a record, or a byte if unstructured, by index"""
+        count = len(self)
+        if pos < 0:
+            pos += count
+        if not 0 <= pos < count:
+            raise IndexError("record index out of range")
+        step = self.record_size or 1
+        start = self.offset + pos * step
+        return self.__mapping[start:start + step]
+
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
+    def sample(self, step):
+        """yield one record out of step"""
+        for i in xrange(0, len(self), step):
+            yield self[i]
+
+
+    def data(self):
+        """return the whole chunk data - a copy"""
+        return self.__mapping[self.offset:self.offset + self.size]
+
+
+    def __repr__(self):
+        if not self.is_structured():
+            return "<BlobView %s: %i bytes, no record layout, at %08X>" % (
+                self.type_, self.size, self.offset)
+        return "<BlobView %s: %i records of %i bytes at %08X>" % (
+            self.type_, len(self), self.record_size, self.offset)
+
+
+class BlobFile(object):
+    """maps a UDD file read-only, and gives lazy views of its blob chunks
+
+    only chunk headers are read to locate them. Views can't be used after
+    the file is closed"""
+
+    def __init__(self, filename, types=BLOB_TYPES, record_sizes=None):
+        """initialization. map the file and locate chunks of the given types
+
+        record_sizes maps type names to the record size of their views;
+        views of other types are unstructured"""
+        if record_sizes is None:
+            record_sizes = {}
+        import mmap
+        self.__views = []
+
+        f = open(filename, "rb")
+        try:
+            try:
+                self.__mapping = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise Error("empty file")
+        finally:
+            f.close()
+
+        m = self.__mapping
+        try:
+            if len(m) < 8:
+                raise Error("truncated file")
+            size = struct.unpack("<I", m[4:8])[0]
+            self.__format = check_header([m[:4], m[8:8 + size]])
+
+            tags = types_to_tags(types, self.__format)
+            offset = 8 + size
+            while (True):
+                if offset + 8 > len(m):
+                    raise Error("truncated file")
+                ct = m[offset:offset + 4]
+                size = struct.unpack("<I", m[offset + 4:offset + 8])[0]
+                if offset + 8 + size > len(m):
+                    raise Error("truncated file")
+
+                if ct in tags:
+                    type_ = CHUNK_TYPES[self.__format][ct]
+                    self.__views.append(BlobView(m, type_, offset + 8, size,
+                        record_sizes.get(type_)))
+                if (ct, size) == (FTR_STRING, 0):
+                    break
+                offset += 8 + size
+        except:
+            m.close()
+            raise
+        return
+
+
+    def get_format(self):
+        """return UDD file format"""
+        return self.__format
+
+
+    def views(self, type_=None, record_size=None):
+        """return the views of all located chunks, or of a given type,
+        with another record size if given"""
+        views = [v for v in self.__views if type_ in (None, v.type_)]
+        if record_size is not None:
+            views = [v.with_record_size(record_size) for v in views]
+        return views
+
+
+    def close(self):
+        """unmap the file"""
+        self.__mapping.close()
+        return
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+        return
+
+
+
+class UddCache(object):
+    """thread-safe, bounded LRU cache of loaded UDD files.
+
+    entries are keyed by (path, size, mtime) and hold read-only snapshots;
+    file sizes are accounted against the byte limit"""
+
+    def __init__(self, max_entries=64, max_bytes=64 * 1024 * 1024):
+        """initialization"""
+        import collections
+        self.__lock = threading.Lock()
+        self.__entries = collections.OrderedDict()
+        self.__bytes = 0
+        self.__stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self.set_limits(max_entries, max_bytes)
+        return
+
+
+    def set_limits(self, max_entries, max_bytes):
+        """change the limits, evicting entries if needed"""
+        with self.__lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self.__evict()
+        return
+
+
+    def __evict(self):
+        """drop least recently used entries until within limits.
+
+        to be called with the lock held"""
+        while self.__entries and (len(self.__entries) > self.max_entries or
+                self.__bytes > self.max_bytes):
+            path, (key, snapshot) = self.__entries.popitem(last=False)
+            self.__bytes -= key[0]
+            self.__stats["evictions"] += 1
+        return
+
+
+    def open(self, path):
+        """return a snapshot of the UDD file at path, loading it if needed"""
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime)
+
+        with self.__lock:
+            entry = self.__entries.pop(path, None)
+            if entry is not None:
+                if entry[0] == key:
+                    self.__entries[path] = entry
+                    self.__stats["hits"] += 1
+                    return entry[1]
+                self.__bytes -= entry[0][0]
+            self.__stats["misses"] += 1
+
+        # parsing is done unlocked, so other files can be served meanwhile
+        snapshot = Udd(path).snapshot()
+
+        with self.__lock:
+            entry = self.__entries.pop(path, None)
+            if entry is not None:
+                self.__bytes -= entry[0][0]
+            if key[0] <= self.max_bytes and self.max_entries > 0:
+                self.__entries[path] = (key, snapshot)
+                self.__bytes += key[0]
+                self.__evict()
+        return snapshot
+
+
+    def invalidate(self, path=None):
+        """drop the entry of a path, or all entries"""
+        with self.__lock:
+            if path is None:
+                self.__entries.clear()
+                self.__bytes = 0
             else:
-                s = ["UNK[%s]:" % i[0][1:4]]
-            s += [print_chunk(i, self.__format)]
-            r += ["".join(s)]
-        return "\n".join(r)
+                entry = self.__entries.pop(os.path.abspath(path), None)
+                if entry is not None:
+                    self.__bytes -= entry[0][0]
+        return
+
+
+    def stats(self):
+        """return hits, misses and evictions counts, entries and bytes used"""
+        with self.__lock:
+            result = dict(self.__stats)
+            result.update(entries=len(self.__entries), bytes=self.__bytes)
+        return result
+
+
+# process-wide cache used by open_cached
+CACHE = UddCache()
 
+def open_cached(path):
+    """return a read-only snapshot of a UDD file, through CACHE"""
+    return CACHE.open(path)
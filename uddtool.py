@@ -7,7 +7,7 @@ Ange Albertini 2010-2013, Public domain
 """
 
 import glob
-import struct
+import os
 import sys
 import collections
 import csv
@@ -36,10 +36,30 @@ actions = [
     "create an empty UDD [referencing <targetfile>]"
     ),
     (
+    "batch",
+    "<outdir> <directory|filemask> [-O2]",
+    "create an empty UDD for each target file, in parallel"
+    ),
+    (
     "list",
     "[<filemask>]",
     "list the structure of (a) UDD file(s)",
-    )
+    ),
+    (
+    "filter",
+    "<infile> <outfile> [-analysis] [-drop <type>] [-rename <old> <new>]",
+    "copy a UDD, stripping analysis or <type> chunks, renaming label prefixes"
+    ),
+    (
+    "fingerprint",
+    "[<filemask>] [-chunks]",
+    "print whole file and user data fingerprints of (a) UDD file(s)"
+    ),
+    (
+    "watch",
+    "<directory> [<statefile>] [-once]",
+    "report label and comment changes of the UDD files in a directory tree"
+    ),
     ]
 
 class StdoutWriter:
@@ -62,29 +82,16 @@ def extract_user_data(udd, format_):
     """extract user-entered MRUs from a UDD"""
     results = [",".join(["type", "text"])]
     if format_ == 11:
-        found = udd.find_by_types(
-            [pyudd.CHUNK_TYPES[11][i]
-                for i in pyudd.CHUNK_TYPES[11]
-                    if i.startswith("MRU_")])
-        for i in found:
-            chk = udd.get_chunk(i)
-            type_ = pyudd.CHUNK_TYPES[11][chk[0]]
-            text = pyudd.expand_chunk(chk, format_)["text"]
-            results += [",".join([type_, text])]
+        for r in udd.query(types=[i for i in pyudd.CHUNK_TYPES[11]
+                if i.startswith("MRU_")]):
+            results += [",".join([r["type"], r["text"]])]
 
     elif format_ == 20:
-        for i in udd.find_by_types(
-            [pyudd.CHUNK_TYPES[20][i]
-                for i in ["Name", "LSA"]]):
-            data = pyudd.expand_chunk(udd.get_chunk(i), format_)
-            if data["category"] in  [
+        for r in udd.query(types=["Name", "LSA"], categories=[
                 'd', 'e', 'p', 'q', 'r', 's', 't', 'u',
                 'v', 'w', 'Y', 'Z', '[', '`', 'a', 'c'
-                ]:
-                type_ = pyudd.OLLY2CATS[data["category"]]
-                text = data["name"]
-
-                results += [",".join([type_, text])]
+                ]):
+            results += [",".join([r["category"], r["text"]])]
 
     print "\n".join(results)
     return
@@ -94,29 +101,15 @@ def export_labcoms(udd):
     # loading the UDD file
     #
     u = pyudd.Udd(udd)
-    format_ = u.get_format()
-
-    # getting all labels or comments chunks
-    #
-    types = [pyudd.CHUNK_TYPES[11][e] for e in "U_LABEL", "U_COMMENT"]
 
-    labcoms = u.find_by_types(types)
-
-    # collecting the information
+    # collecting all labels or comments
     #
-
-    #TODO: multi format
-    format_ = 11
-
     d = collections.OrderedDict()
-    for i in labcoms:
-        ct, cd = u.get_chunk(i)
-
-        data = pyudd.expand_chunk([ct, cd], format_)
-        RVA, text = data["dword"], data["text"]
+    for r in u.query(categories=["UserLabel", "UserComment"]):
+        RVA, text = r["RVA"], r["text"]
         if RVA not in d:
             d[RVA] = ["",""]
-        if ct == pyudd.CHUNK_TYPES[format_]["U_LABEL"]:
+        if r["category"] == "UserLabel":
             d[RVA][0] = text
         else:
             d[RVA][1] = text
@@ -128,6 +121,104 @@ def export_labcoms(udd):
     for i in d:
         csvwriter.writerow(["%08X" % i, d[i][0], d[i][1]])
 
+def filter_udd(infile, outfile, args):
+    """stream a UDD to a new file, applying stages from the command line"""
+    stages = []
+    drop = []
+    i = 0
+    while i < len(args):
+        if args[i] == "-analysis":
+            drop += pyudd.ANALYSIS_TYPES
+        elif args[i] == "-drop" and i + 1 < len(args):
+            if all(pyudd.type_to_tag(args[i + 1], f) is None
+                    for f in pyudd.CHUNK_TYPES):
+                print "error: unknown chunk type '%s'" % args[i + 1]
+                rtfm()
+            drop += [args[i + 1]]
+            i += 1
+        elif args[i] == "-rename" and i + 2 < len(args):
+            stages += [pyudd.rename_label_prefix(args[i + 1], args[i + 2])]
+            i += 2
+        else:
+            print "error: invalid filter argument '%s'" % args[i]
+            rtfm()
+        i += 1
+
+    if drop:
+        stages.insert(0, pyudd.drop_types(drop))
+
+    pyudd.transform_file(infile, outfile, stages)
+    return
+
+def print_fingerprints(filemask, chunks):
+    """print the fingerprints of UDD files, and of their chunks if asked"""
+    for f in glob.glob(filemask):
+        u = pyudd.Udd(filename=f)
+        print "%08X %08X %s" % (u.fingerprint(), u.fingerprint(True), f)
+
+        if chunks:
+            format_ = u.get_format()
+            for i, fp in enumerate(u.get_fingerprints()):
+                ct = u.get_chunk(i)[0]
+                name = pyudd.CHUNK_TYPES[format_].get(ct, "UNK[%s]" % ct[1:4])
+                print "    %08X %s" % (fp, name)
+    return
+
+def watch_directory(root, state, once):
+    """print label and comment changes in a directory tree as CSV"""
+    csvwriter = csv.writer(StdoutWriter())
+    csvwriter.writerow(["event", "file", "kind", "RVA", "text"])
+
+    def report(event):
+        csvwriter.writerow(list(event[:3]) + ["%08X" % event[3], event[4]])
+        sys.stdout.flush()
+
+    pyudd.UddWatcher(root, state).watch(report, once=once)
+    return
+
+def create_udd_file(job):
+    """create a UDD for a target file - pool worker"""
+    target, uddfile, format_ = job
+    try:
+        pyudd.create_udd(target, format_).save(uddfile)
+    except Exception, e:
+        return "error: %s: %s" % (target, e)
+    return uddfile
+
+def create_batch(outdir, targets, format_):
+    """create UDD files for all targets, using all CPUs"""
+    import multiprocessing
+
+    if os.path.isdir(targets):
+        targets = os.path.join(targets, "*")
+
+    # UDDs are named after the target without extension: targets sharing
+    # a name (foo.exe, foo.dll) would overwrite each other's UDD
+    outputs = collections.OrderedDict()
+    for f in sorted(glob.glob(targets)):
+        if os.path.isfile(f):
+            uddfile = os.path.join(outdir,
+                os.path.splitext(os.path.basename(f))[0] + ".udd")
+            outputs.setdefault(uddfile.lower(), (uddfile, []))[1].append(
+                os.path.abspath(f))
+
+    jobs = []
+    for uddfile, files in outputs.values():
+        if len(files) > 1:
+            print "error: %s: same UDD for %s, skipped" % (
+                uddfile, ", ".join(files))
+        else:
+            jobs += [(files[0], uddfile, format_)]
+
+    pool = multiprocessing.Pool()
+    try:
+        for result in pool.imap_unordered(create_udd_file, jobs):
+            print result
+    finally:
+        pool.close()
+        pool.join()
+    return
+
 def main():
     """parse arguments then call relevant function"""
     arglen = len(sys.argv)
@@ -149,34 +240,20 @@ def main():
 
         #TODO: cleaner parameter reading
         format_ = 20 if "-O2" in sys.argv else 11
+        args = [e for e in sys.argv[3:] if e != "-O2"]
 
-        u = pyudd.Udd()
-        u.append_chunk([pyudd.HDR_STRING, pyudd.UDD_FORMATS[format_]])
-
-        if arglen > 3:
-            filename = sys.argv[3]
-            time_, crc, size = pyudd.getFileInfo(filename)
-
-            u.append_chunk(
-                [pyudd.CHUNK_TYPES[format_]["Filename"], sys.argv[3]]
-                )
-
-            #TODO: QA for format 20
-            u.append_chunk(
-                [pyudd.CHUNK_TYPES[format_]["Size"], struct.pack("<I", size)]
-                )
-            u.append_chunk(
-                [pyudd.CHUNK_TYPES[format_]["Timestamp"], time_]
-                )
-            u.append_chunk(
-                [pyudd.CHUNK_TYPES[format_]["CRC"], struct.pack("<I", crc)]
-                )
-
-        u.append_chunk([pyudd.FTR_STRING, ""])
-        u.save(uddfile)
+        filename = args[0] if args else None
+        pyudd.create_udd(filename, format_).save(uddfile)
 
         sys.exit()
 
+    elif action == "batch":
+        format_ = 20 if "-O2" in sys.argv else 11
+        args = [e for e in sys.argv[2:] if e != "-O2"]
+        if len(args) < 2:
+            rtfm()
+        create_batch(args[0], args[1], format_)
+
     elif action == "list":
         #TODO: turn that into a procedure
         if arglen < 3:
@@ -214,28 +291,19 @@ def main():
         csvreader = csv.reader(f)
         format_ = u.get_format()
 
-        for d in csvreader:
-            # skip the header
-            #
-            if d[0] == "RVA":
-                continue
-
-            # extract information
-            #
-            RVA, label, comment  = int(d[0],16), d[1], d[2]
-
-            # save new information
-            #
-            if label != "":
-                u.add_chunk(pyudd.make_label_chunk(
-                    {"dword":RVA, "text":label}, format_)
-                    )
-            if comment != "":
-                u.add_chunk(pyudd.make_comment_chunk(
-                    {"dword":RVA, "text":comment}, format_)
-                    )
-
+        # extract information, skipping the header
+        #
+        records = [(int(d[0], 16), d[1], d[2])
+            for d in csvreader if d[0] != "RVA"]
         f.close()
+
+        # save new information
+        #
+        chunks, rejected = pyudd.build_annotation_chunks(records, format_)
+        for i, RVA, field, error in rejected:
+            print "warning: skipping %08X %s: %s" % (RVA, field, error)
+
+        u.add_chunks(chunks)
         u.save(uddfile)
 
     elif action == "export":
@@ -255,6 +323,23 @@ def main():
 
         extract_user_data(u, u.get_format())
 
+    elif action == "filter":
+        if arglen < 4:
+            rtfm()
+        filter_udd(sys.argv[2], sys.argv[3], sys.argv[4:])
+
+    elif action == "fingerprint":
+        args = [e for e in sys.argv[2:] if e != "-chunks"]
+        arg = args[0] if args else "*.udd"
+        print_fingerprints(arg, "-chunks" in sys.argv)
+
+    elif action == "watch":
+        args = [e for e in sys.argv[2:] if e != "-once"]
+        if not args:
+            rtfm()
+        state = args[1] if len(args) > 1 else None
+        watch_directory(args[0], state, "-once" in sys.argv)
+
 
 if __name__ == '__main__':
     main()